@@ -570,7 +570,7 @@ def analyze_file(raw_our_path, output_file):
     return 0
 
   with open(output_file, 'wb') as f:
-    cPickle.dump(stats, f)
+    cPickle.dump(stats, f, cPickle.HIGHEST_PROTOCOL)
   with open(output_file + '.d', 'wt') as f:
     f.write(output_file + ': \\\n')
     f.write(' ' + our_path)
@@ -7,8 +7,9 @@
 """A git pre-push hook script."""
 
 import fnmatch
-import md5
+import hashlib
 import os.path
+import stat
 import subprocess
 import sys
 
@@ -37,13 +38,30 @@ def _check_uncommitted_change():
   return 0
 
 
+def _filter_regular_files(files):
+  """Returns the sorted list of |files| which are regular files.
+
+  Each file is stat'ed exactly once; files which cannot be stat'ed are
+  dropped, as os.path.isfile() would do.
+  """
+  result = []
+  for f in sorted(files):
+    try:
+      mode = os.stat(f).st_mode
+    except OSError:
+      continue
+    if stat.S_ISREG(mode):
+      result.append(f)
+  return result
+
+
 def _check_lint(push_files):
   ignore_file = os.path.join('src', 'build', 'lint_ignore.txt')
   # If push_files contains any directories (representing submodules), filter
   # them out. Passing a directory to the lint_source.process will cause all
   # the files in that directory to be checked for lint errors, when those files
   # may not even conform to the standards of the current project.
-  push_files = filter(os.path.isfile, push_files)
+  push_files = _filter_regular_files(push_files)
   result = lint_source.process(push_files, ignore_file)
   if result != 0:
     print ''
@@ -163,13 +181,10 @@ def _check_docs(push_files):
 
 
 def _get_file_list_digest(files):
-  digest = md5.new()
-  for f in sorted(files):
-    digest.update(f)
-    # Add a file path separator.  chr(1) is unlikely to be part of a
-    # file path.
-    digest.update(chr(1))
-  return digest.hexdigest()
+  # Terminate each file path with a separator.  chr(1) is unlikely to be part
+  # of a file path.  The paths are joined up front so the whole list is hashed
+  # with a single update() call.
+  return hashlib.md5(''.join(f + chr(1) for f in sorted(files))).hexdigest()
 
 
 def _has_file_list_changed_since_last_push(files):
@@ -202,7 +217,9 @@ def get_push_files():
 
 
 def main():
-  push_files = get_push_files()
+  # The checks below only test membership or iterate over the files, so a
+  # frozenset makes the 'not in push_files' lookups O(1).
+  push_files = frozenset(get_push_files())
   if not push_files:
     return 0
 
@@ -5,6 +5,7 @@
 # found in the LICENSE file.
 
 import logging
+import os
 import re
 import subprocess
 import sys
@@ -14,10 +15,12 @@ import traceback
 _BUG_PREFIX = 'BUG='
 _PERF_PREFIX = 'PERF='
 _TEST_PREFIX = 'TEST='
-_PREFIXES = [_TEST_PREFIX, _PERF_PREFIX, _BUG_PREFIX]
+_PREFIXES = (_TEST_PREFIX, _PERF_PREFIX, _BUG_PREFIX)
 
 _CHANGED_FILE_RE = re.compile(r'.*?:\s+(.*)')
 _CRBUG_URL_RE = re.compile(r'crbug.com/(\d{6,})')
+_EMPTY_BUG_RE = re.compile(r'(n/a|none)', re.IGNORECASE)
+_BUG_SEPARATOR_RE = re.compile(r',\s*')
 
 
 def _append_prefixes(existing_prefixes, output_lines):
@@ -41,18 +44,20 @@ def add_mandatory_lines(lines):
   """Adds mandatory lines such as TEST= to the commit message."""
   output_lines = []
   existing_prefixes = set()
-  while lines:
-    line = lines.pop(0)
-    for prefix in _PREFIXES:
-      if line.startswith(prefix):
-        existing_prefixes.add(prefix)
+  # Scan by index instead of popping from the head of |lines|, which would
+  # make this quadratic in the length of the message.
+  end = len(lines)
+  for index, line in enumerate(lines):
+    if line.startswith(_PREFIXES):
+      # The prefixes are mutually exclusive and all end with '='.
+      existing_prefixes.add(line[:line.index('=') + 1])
     if line.startswith('#') or line.startswith('Change-Id:'):
-      lines = [line] + lines
+      end = index
       break
     output_lines.append(line)
 
   _append_prefixes(existing_prefixes, output_lines)
-  return output_lines + lines
+  return output_lines + lines[end:]
 
 
 def get_bug_ids_from_diffs(diffs):
@@ -85,11 +90,11 @@ def update_bug_line(lines, bug_ids):
     return lines
 
   def _reject_empty_bug(bug_id):
-    return not re.match(r'(n/a|none)', bug_id, flags=re.IGNORECASE)
+    return not _EMPTY_BUG_RE.match(bug_id)
 
   for index, line in enumerate(lines):
     if line.startswith(_BUG_PREFIX):
-      orig_bug_ids = re.split(r',\s*', line[len(_BUG_PREFIX):].strip())
+      orig_bug_ids = _BUG_SEPARATOR_RE.split(line[len(_BUG_PREFIX):].strip())
       orig_bug_ids = [bug_id for bug_id in orig_bug_ids if bug_id]
       bug_ids.update(set(filter(_reject_empty_bug, orig_bug_ids)))
       orig_bug_ids_str = ', '.join(sorted(orig_bug_ids))
@@ -151,10 +156,22 @@ def _detect_and_update_bug_id(lines):
   lines = update_bug_line(lines, bug_ids)
 
 
+def _write_file_atomically(path, data):
+  """Writes |data| to |path| via a temporary file and a rename.
+
+  Editors which poll the commit message file never observe a partially
+  written file this way.
+  """
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(data)
+  os.rename(tmp_path, path)
+
+
 if __name__ == '__main__':
   commit_file = sys.argv[1]
-  with open(commit_file) as f:
-    lines = f.readlines()
+  with open(commit_file, 'rb') as f:
+    lines = f.read().splitlines(True)
 
   lines = add_mandatory_lines(lines)
   # This function is not trivial and may raise an exception. As bug ID
@@ -167,5 +184,4 @@ if __name__ == '__main__':
                      'filled automatically ***\n')
     traceback.print_exc()
 
-  with open(commit_file, 'w') as f:
-    f.write(''.join(lines))
+  _write_file_atomically(commit_file, ''.join(lines))
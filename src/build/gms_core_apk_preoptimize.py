@@ -6,16 +6,19 @@
 
 import argparse
 import hashlib
+import json
+import multiprocessing
 import os
-import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 
 from src.build import build_common
 from src.build import toolchain
 from src.build.build_options import OPTIONS
+from src.build.util import concurrent
 from src.build.util import file_util
 
 _SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -24,6 +27,22 @@ _ARC_ROOT = os.path.dirname(os.path.dirname(_SCRIPT_DIR))
 _SUBAPK_PATH = 'assets/chimera-modules'
 _SUBAPK_PATTERN = os.path.join(_SUBAPK_PATH, '*.apk')
 
+# Bounds of the size of the chunks read when calculating a file checksum.
+# See _get_sha1_chunk_size() for details.
+_MIN_SHA1_CHUNK_SIZE = 1024 * 1024
+_MAX_SHA1_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Size of the buffer used to copy the outer apk.
+_COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Name of the file, placed next to the output apk, which caches the SHA1
+# digests of the inner apks across builds.
+_SHA1_CACHE_NAME = 'gms_core_subapk_sha1.json'
+
+# Name of the directory, placed next to the output apk, which caches the odex
+# files of the inner apks across builds.
+_ODEX_CACHE_NAME = 'gms_core_subapk_odex'
+
 
 def _get_apk_install_location(sha1sum, filename):
   pattern = ('/data/data/com.google.android.gms/app_chimera/' +
@@ -31,50 +50,266 @@ def _get_apk_install_location(sha1sum, filename):
   return pattern % (sha1sum, filename)
 
 
+def _get_sha1_chunk_size(path):
+  """Returns the size of the chunks to read |path| in for checksumming.
+
+  The size can be overridden by the ARC_SHA1_CHUNK environment variable.
+  Otherwise it is derived from the block size of the file system holding
+  |path|, clamped to [_MIN_SHA1_CHUNK_SIZE, _MAX_SHA1_CHUNK_SIZE].
+  """
+  override = os.environ.get('ARC_SHA1_CHUNK')
+  if override:
+    return int(override)
+  try:
+    block_size = os.statvfs(path).f_bsize
+  except OSError:
+    return _MAX_SHA1_CHUNK_SIZE
+  return min(max(_MIN_SHA1_CHUNK_SIZE, 16 * block_size), _MAX_SHA1_CHUNK_SIZE)
+
+
 def _calc_sha1(path):
   """Calculates the SHA1 checksum of the file.
 
   The SHA1 digest is used to derive the path where the inner apk (and the odex)
   is expanded during runtime.
   """
+  # hashlib is backed by OpenSSL, which already uses the CPU's SHA extensions
+  # where available.  Keep the Python side of the loop minimal: read into one
+  # reusable buffer and hand each chunk to update() without copying it.
   calc = hashlib.sha1()
-  with open(path, 'r') as f:
-    calc.update(f.read())
+  buf = bytearray(_get_sha1_chunk_size(path))
+  view = memoryview(buf)
+  with open(path, 'rb') as f:
+    while True:
+      size = f.readinto(buf)
+      if not size:
+        break
+      calc.update(view[:size])
   return calc.hexdigest()
 
 
+def _copy_file(src, dest):
+  """Copies the content of |src| to |dest|.
+
+  Unlike shutil.copyfile(), which copies in 16 KiB chunks on Python 2, this
+  uses a large buffer to reduce the number of read and write calls for
+  multi-hundred-MB apks.
+  """
+  with open(dest, 'wb') as dest_file:
+    _copy_file_object(src, dest_file)
+
+
+def _copy_file_object(src, dest_file):
+  """Copies the content of |src| to the file object |dest_file|."""
+  with open(src, 'rb') as src_file:
+    shutil.copyfileobj(src_file, dest_file, _COPY_BUFFER_SIZE)
+
+
+def _list_subapk_entries(src_apk):
+  """Lists the inner apks contained in |src_apk|.
+
+  Returns:
+    A dict mapping the path of each inner apk in |src_apk| to a string which
+    identifies its content, built from the path, the uncompressed size and
+    the CRC-32 recorded in the zip directory.
+  """
+  cmd = ['unzip', '-lv', src_apk, _SUBAPK_PATTERN]
+  p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+  output = p.communicate()[0]
+  # unzip exits with 11 when no entry matches the pattern.
+  if p.returncode not in (0, 11):
+    raise subprocess.CalledProcessError(p.returncode, cmd)
+  # Each entry line looks like:
+  #   <length> <method> <size> <ratio> <date> <time> <crc32>  <name>
+  entries = {}
+  for line in output.splitlines():
+    fields = line.split(None, 7)
+    if len(fields) == 8 and os.path.dirname(fields[7]) == _SUBAPK_PATH:
+      entries[fields[7]] = ':'.join([fields[7], fields[0], fields[6]])
+  return entries
+
+
+class _Sha1Cache(object):
+  """Caches the SHA1 digests of inner apks across builds.
+
+  Inner apks rarely change between GmsCore builds, so their digests are
+  looked up by the size and CRC-32 of their zip entry instead of being
+  recalculated each time.
+  """
+
+  def __init__(self, path):
+    self._path = path
+    self._lock = threading.Lock()
+    self._digests = {}
+    self._dirty = False
+    try:
+      with open(path) as f:
+        self._digests = json.load(f)
+    except (IOError, ValueError):
+      # A missing or broken cache is simply rebuilt.
+      pass
+
+  def get_sha1(self, apk_path, entry_key):
+    """Returns the SHA1 digest of |apk_path|, calculating it if needed."""
+    if entry_key is not None:
+      with self._lock:
+        digest = self._digests.get(entry_key)
+      if digest:
+        return digest
+    digest = _calc_sha1(apk_path)
+    if entry_key is not None:
+      with self._lock:
+        self._digests[entry_key] = digest
+        self._dirty = True
+    return digest
+
+  def save(self):
+    if self._dirty:
+      file_util.write_atomically(self._path, json.dumps(self._digests))
+
+
+def _get_dex2oat_cmd(apk_path, odex_path, install_path):
+  return [
+      'src/build/filter_dex2oat_warnings.py',
+      toolchain.get_tool('java', 'dex2oat')
+  ] + build_common.get_dex2oat_for_apk_flags(
+      apk_path=apk_path,
+      apk_install_path=install_path,
+      output_odex_path=odex_path)
+
+
+def _run_dex2oat(apk_path, odex_path, install_path):
+  """Compiles |apk_path| into |odex_path|. Returns True on success."""
+  dex2oat_cmd = _get_dex2oat_cmd(apk_path, odex_path, install_path)
+  if subprocess.call(dex2oat_cmd, cwd=_ARC_ROOT) != 0:
+    print 'ERROR: preoptimize failed for %s.' % apk_path
+    return False
+  return True
+
+
+def _get_dex2oat_input_stamp():
+  """Returns a list identifying dex2oat and the boot image it compiles against.
+
+  The odex files depend on them in addition to the inner apks.
+  """
+  boot_image_dir = os.path.join(build_common.get_android_fs_root(),
+                                'system/framework', build_common.get_art_isa())
+  stamp = []
+  for path in [toolchain.get_tool('java', 'dex2oat'),
+               os.path.join(boot_image_dir, 'boot.art'),
+               os.path.join(boot_image_dir, 'boot.oat')]:
+    st = os.stat(os.path.join(_ARC_ROOT, path))
+    stamp.append([path, st.st_size, st.st_mtime])
+  return stamp
+
+
+class _OdexCache(object):
+  """Caches the odex files of inner apks across builds.
+
+  An odex file is looked up by a digest of everything dex2oat output depends
+  on: the apk content (through its install path, which contains the apk
+  SHA1), the dex2oat command line and the dex2oat binary and boot image.
+  Inner apks rarely change between GmsCore builds, so dex2oat is skipped for
+  most of them on incremental builds.
+  """
+
+  def __init__(self, cache_dir):
+    self._cache_dir = cache_dir
+    self._input_stamp = _get_dex2oat_input_stamp()
+    self._lock = threading.Lock()
+    self._used_paths = set()
+    file_util.makedirs_safely(cache_dir)
+
+  def get_path(self, install_path):
+    """Returns the path of the cached odex file for |install_path|."""
+    # The apk and odex paths are in a temporary directory, so leave them out
+    # of the key.
+    key = json.dumps([self._input_stamp,
+                      _get_dex2oat_cmd('', '', install_path)])
+    path = os.path.join(self._cache_dir,
+                        hashlib.sha1(key).hexdigest() + '.odex')
+    with self._lock:
+      self._used_paths.add(path)
+    return path
+
+  def prune(self):
+    """Removes the cached odex files not used in this run."""
+    for path in file_util.glob(os.path.join(self._cache_dir, '*.odex')):
+      if path not in self._used_paths:
+        file_util.remove_file_force(path)
+
+
+def _preoptimize_one_subapk(apk_path, odex_path, entry_key, sha1_cache,
+                            odex_cache):
+  """Compiles one inner apk. Returns True on success."""
+  # On a cache miss, the apk has just been extracted, and hashing it right
+  # before running dex2oat keeps its pages hot in the page cache, so dex2oat
+  # does not read it from disk a second time.
+  sha1 = sha1_cache.get_sha1(apk_path, entry_key)
+  install_path = _get_apk_install_location(sha1, os.path.basename(apk_path))
+
+  cached_odex_path = odex_cache.get_path(install_path)
+  if os.path.isfile(cached_odex_path) and os.path.getsize(cached_odex_path):
+    _copy_file(cached_odex_path, odex_path)
+    return True
+
+  if not _run_dex2oat(apk_path, odex_path, install_path):
+    return False
+  file_util.generate_file_atomically(
+      cached_odex_path,
+      lambda f: _copy_file_object(odex_path, f))
+  return True
+
+
 def _preoptimize_subapk(src_apk, dest_apk, work_dir):
-  # Extract inner apks from |src_apk|.
   # Note that we cannot use Python zipfile module for handling apk.
   # See: https://bugs.python.org/issue14315.
-  subprocess.call(['unzip', '-q', src_apk, _SUBAPK_PATTERN, '-d', work_dir])
-  inner_apk_list = file_util.glob(os.path.join(work_dir, _SUBAPK_PATTERN))
+  # Rewriting |dest_apk| with zipfile is not an option either, as zipfile
+  # does not preserve the zipalign padding of stored entries.  'aapt add'
+  # below appends the odex files and keeps the existing entries untouched.
+  entries = _list_subapk_entries(src_apk)
+  sha1_cache = _Sha1Cache(
+      os.path.join(os.path.dirname(dest_apk), _SHA1_CACHE_NAME))
+  odex_cache = _OdexCache(
+      os.path.join(os.path.dirname(dest_apk), _ODEX_CACHE_NAME))
 
-  # Optimize each apk and place the output odex next to the apk.
+  # Extract the inner apks one by one, and compile each of them in parallel
+  # as soon as it is extracted, so that extraction (disk bound) overlaps with
+  # dex2oat (CPU bound). The output odex is placed next to the apk.
   odex_files = []
-  for apk_path in inner_apk_list:
-    apk_name = os.path.basename(apk_path)
-    odex_name = re.sub(r'\.apk$', '.odex', apk_name)
-    odex_path_in_apk = os.path.join(_SUBAPK_PATH, odex_name)
-    odex_path = os.path.join(work_dir, odex_path_in_apk)
-    odex_files.append(odex_path_in_apk)
-    install_path = _get_apk_install_location(_calc_sha1(apk_path), apk_name)
-
-    dex2oat_cmd = [
-        'src/build/filter_dex2oat_warnings.py',
-        toolchain.get_tool('java', 'dex2oat')
-    ] + build_common.get_dex2oat_for_apk_flags(
-        apk_path=apk_path,
-        apk_install_path=install_path,
-        output_odex_path=odex_path)
-    if subprocess.call(dex2oat_cmd, cwd=_ARC_ROOT) != 0:
-      print 'ERROR: preoptimize failed for %s.' % apk_path
-      return False
+  futures = []
+  with concurrent.ThreadPoolExecutor(
+      max_workers=max(1, min(len(entries), multiprocessing.cpu_count())),
+      daemon=True) as executor:
+    for entry in sorted(entries):
+      if any(future.done() and not future.result() for future in futures):
+        # Some dex2oat already failed. No need to extract the rest.
+        break
+      subprocess.check_call(['unzip', '-q', src_apk, entry, '-d', work_dir])
+      odex_path_in_apk = os.path.splitext(entry)[0] + '.odex'
+      odex_files.append(odex_path_in_apk)
+      futures.append(executor.submit(
+          _preoptimize_one_subapk, os.path.join(work_dir, entry),
+          os.path.join(work_dir, odex_path_in_apk), entries[entry],
+          sha1_cache, odex_cache))
+
+    for future in futures:
+      if not future.result():
+        # Do not start the remaining tasks. The running ones are waited for
+        # on exit from the with-statement.
+        for pending_future in futures:
+          pending_future.cancel()
+        return False
+  sha1_cache.save()
+  odex_cache.prune()
 
   # Prepare |dest_apk|.
-  shutil.copyfile(src_apk, dest_apk)
+  _copy_file(src_apk, dest_apk)
 
-  # Add odex files to |dest_apk| by using aapt.
+  # Add odex files to |dest_apk| by using aapt.  Keep this a single aapt
+  # invocation: 'aapt add' appends the new entries and rewrites only the
+  # central directory, whereas adding files one by one would rewrite it for
+  # each odex file.
   if odex_files:
     aapt_add_cmd = [os.path.join(_ARC_ROOT, toolchain.get_tool('java', 'aapt')),
                     'add', os.path.join(_ARC_ROOT, dest_apk)] + odex_files
@@ -9,7 +9,11 @@
 See docs/working-on-lol5.md for usage.
 """
 
+from __future__ import print_function
+
 import argparse
+import json
+import os
 import pipes
 import re
 import subprocess
@@ -52,10 +56,34 @@ import sys
 #                    origin/lol5
 
 
+try:
+  _input = raw_input
+except NameError:
+  # Python 3.
+  _input = input
+
+
 # git-log pretty format used internally to parse git commits.
 _LOG_FORMAT = '%H%n%P%n%ae%n%B'
 
+# Size of the blocks read from git-log output.
+_READ_SIZE = 64 * 1024
+
 _CHERRY_PICK_COMMENT_RE = re.compile(r'cherry picked from commit ([0-9a-f]+)')
+_METADATA_RE = re.compile(r'(.*?)^[A-Z]+=', re.DOTALL | re.MULTILINE)
+_REVIEWED_ON_RE = re.compile(r'^(Reviewed-on: .*)$', re.MULTILINE)
+_MERGE_HEAD_RE = re.compile(r'MERGE_HEAD=(.+)')
+
+# Name of the file under the git directory recording the status of the
+# incremental merge process in progress. See get_merge_status().
+_STATE_FILE_NAME = 'incremental_merge_state'
+
+# Path to the state file, resolved by _get_state_file_path().
+_state_file_path = None
+
+# Whether ensure_clean_tree_or_die() has verified the working tree since the
+# last operation which may have modified it.
+_tree_checked = False
 
 
 def clear_screen():
@@ -73,7 +101,13 @@ def prepend_indent(text, width):
   Returns:
     An indented multi-line text.
   """
-  return '\n'.join((' ' * width + line) for line in text.splitlines())
+  lines = text.splitlines()
+  if not lines:
+    return ''
+  # Fold the indentation into the separator so that the result is built by a
+  # single join() without a per-line concatenation.
+  indent = ' ' * width
+  return indent + ('\n' + indent).join(lines)
 
 
 def run_git_merge(commit, use_strategy_ours=False):
@@ -86,6 +120,7 @@ def run_git_merge(commit, use_strategy_ours=False):
   Returns:
     The return code of git-merge command.
   """
+  global _tree_checked
   args = ['git', 'merge']
   if use_strategy_ours:
     args.append('--strategy=ours')
@@ -97,14 +132,24 @@ def run_git_merge(commit, use_strategy_ours=False):
           'subject': commit['subject'],
       })
   args.extend(['-m', commit_message, commit['hash']])
-  print '+ %s' % ' '.join(pipes.quote(s) for s in args)
+  print('+ %s' % ' '.join(pipes.quote(s) for s in args))
+  # A merge may leave conflicts in the working tree.
+  _tree_checked = False
   return subprocess.call(args)
 
 
 def ensure_clean_tree_or_die():
-  """Ensures the git checkout is clean, otherwise abort."""
+  """Ensures the git checkout is clean, otherwise abort.
+
+  The result is remembered, so that handlers chaining into each other (e.g.
+  "start" running "continue") run git-diff only once.
+  """
+  global _tree_checked
+  if _tree_checked:
+    return
   if subprocess.call(['git', 'diff', '--quiet', '--ignore-submodules']):
     sys.exit('ERROR: The working tree is not clean.')
+  _tree_checked = True
 
 
 def parse_log_chunk(chunk):
@@ -124,10 +169,10 @@ def parse_log_chunk(chunk):
   # We assume the first line starting with r"[A-Z]+=" (e.g. "TEST=") is
   # the beginning of metadata lines and drop them, except for the last
   # "Reviewed-on:" line which is actually useful.
-  main_match = re.search(r'(.*?)^[A-Z]+=', body, re.DOTALL | re.MULTILINE)
+  main_match = _METADATA_RE.search(body)
   if main_match:
     short_body = main_match.group(1).strip()
-    review_lines = re.findall(r'^(Reviewed-on: .*)$', body, re.MULTILINE)
+    review_lines = _REVIEWED_ON_RE.findall(body)
     if review_lines:
       short_body += '\n\n%s\n' % review_lines[-1]
   else:
@@ -157,9 +202,37 @@ def get_commit(revision):
   return parse_log_chunk(output)
 
 
+def _iter_nul_separated_chunks(stream):
+  """Yields NUL-separated chunks read from |stream| as they arrive.
+
+  Args:
+    stream: A file object to read from.
+
+  Yields:
+    Each chunk of the stream, without the separator.
+  """
+  buf = ''
+  while True:
+    data = stream.read(_READ_SIZE)
+    if not data:
+      break
+    buf += data
+    chunks = buf.split('\0')
+    # The last element is an incomplete chunk (or empty if |buf| ended with a
+    # separator). Keep it until more data arrives.
+    buf = chunks.pop()
+    for chunk in chunks:
+      yield chunk
+  if buf:
+    yield buf
+
+
 def get_commits_with_args(extra_args):
   """Runs `git log $args` and parses the output.
 
+  Commits are parsed while git-log is still running, so the whole output is
+  never held in memory at once.
+
   Args:
     extra_args: A list of strings given to `git log` as extra arguments.
 
@@ -168,11 +241,15 @@ def get_commits_with_args(extra_args):
   """
   args = ['git', 'log', '--pretty=format:%s%%x00' % _LOG_FORMAT,
           '--topo-order', '--reverse'] + extra_args
-  output = subprocess.check_output(args)
+  p = subprocess.Popen(args, stdout=subprocess.PIPE)
   commits = [
       parse_log_chunk(chunk.strip())
-      for chunk in output.split('\0')
+      for chunk in _iter_nul_separated_chunks(p.stdout)
       if chunk.strip()]
+  p.stdout.close()
+  returncode = p.wait()
+  if returncode != 0:
+    raise subprocess.CalledProcessError(returncode, args)
   return commits
 
 
@@ -206,9 +283,63 @@ def grep_commits(pattern):
   return get_commits_with_args(['--grep=%s' % pattern])
 
 
+def _get_state_file_path():
+  """Returns the path to the state file in the git directory.
+
+  The git directory is not necessarily .git/ in the current directory, e.g. in
+  submodule checkouts and linked worktrees, where .git is a file.
+  """
+  global _state_file_path
+  if _state_file_path is None:
+    _state_file_path = subprocess.check_output(
+        ['git', 'rev-parse', '--git-path', _STATE_FILE_NAME]).strip()
+  return _state_file_path
+
+
+def _save_merge_status(status):
+  """Records the incremental merge process status in the state file."""
+  try:
+    with open(_get_state_file_path(), 'w') as f:
+      json.dump(status, f)
+  except (IOError, OSError) as e:
+    # The state file is just a cache. get_merge_status() falls back to
+    # searching the history without it.
+    print('WARNING: Failed to record the merge status: %s' % e,
+          file=sys.stderr)
+
+
+def _clear_merge_status():
+  """Removes the state file if it exists."""
+  try:
+    os.remove(_get_state_file_path())
+  except OSError:
+    pass
+
+
+def _load_merge_status():
+  """Returns the status recorded in the state file, or None if it is stale."""
+  try:
+    with open(_get_state_file_path()) as f:
+      status = json.load(f)
+    start_hash = status['start_hash']
+  except (IOError, ValueError, KeyError, TypeError):
+    return None
+  # The process may have been finished or abandoned without this script
+  # (e.g. by git-reset), so make sure the start commit is still in HEAD.
+  if subprocess.call(['git', 'merge-base', '--is-ancestor',
+                      start_hash, 'HEAD']) != 0:
+    _clear_merge_status()
+    return None
+  return status
+
+
 def get_merge_status():
   """Returns the incremental merge process status.
 
+  The status is read from the state file written by "start" command, so that
+  the whole history does not need to be searched for the start commit on
+  every invocation.
+
   Returns:
     A dictionary containing two entries:
     - 'start_hash': The hash of the commit created by initial "start" command.
@@ -216,15 +347,42 @@ def get_merge_status():
           to be merged as specified in initial "start" command.
     If an incremental merge process has not started yet, None is returned.
   """
+  status = _load_merge_status()
+  if status:
+    return status
+
+  # Fall back to searching the history, e.g. for a process started before
+  # the state file was introduced.
   output = subprocess.check_output(
       ['git', 'log', '-1', '--pretty=format:%H%n%B',
        '--grep=INCREMENTAL_MERGE=START'])
   if not output:
     return None
   start_hash, start_body = output.split('\n', 1)
-  m = re.search(r'MERGE_HEAD=(.+)', start_body)
+  m = _MERGE_HEAD_RE.search(start_body)
   merge_head = m.group(1)
-  return {'start_hash': start_hash, 'merge_head': merge_head}
+  status = {'start_hash': start_hash, 'merge_head': merge_head}
+  _save_merge_status(status)
+  return status
+
+
+def simplify_subject(subject):
+  """Strips well-known branch prefixes from a commit subject line.
+
+  We are conservative here with whitelisted prefixes so as not to match
+  "Fix foobar" with "Reland: Fix foobar" etc.
+
+  Args:
+    subject: A commit subject line.
+
+  Returns:
+    The subject line used to match commits with each other.
+  """
+  s = subject.strip()
+  for prefix in ('lol5:', 'l-rebase:'):
+    if s.lower().startswith(prefix):
+      s = s[len(prefix):].strip()
+  return s
 
 
 def is_cherry_pick(their_commit, our_commit):
@@ -245,15 +403,6 @@ def is_cherry_pick(their_commit, our_commit):
     return True
 
   # Secondly, match changes with the subject lines.
-  # We are conservative here with whitelisted prefixes so as not to match
-  # "Fix foobar" with "Reland: Fix foobar" etc.
-  def simplify_subject(s):
-    s = s.strip()
-    for prefix in ('lol5:', 'l-rebase:'):
-      if s.lower().startswith(prefix):
-        s = s[len(prefix):].strip()
-    return s
-
   if (simplify_subject(their_commit['subject']) ==
       simplify_subject(our_commit['subject'])):
     return True
@@ -266,7 +415,8 @@ def mark_cherry_picks(their_commits, our_commits):
 
   If a commit in their_commits has a corresponding cherry-pick commit in
   our_commits, its commit['cherry_pick_hash'] is set to the hash of the
-  other commit.
+  other commit. If several commits in our_commits match, the first one is
+  used, as is_cherry_pick() would find it.
 
   Args:
     their_commits: A list of commit dictionaries reachable only from the
@@ -274,12 +424,29 @@ def mark_cherry_picks(their_commits, our_commits):
     our_commits: A list of commit dictionaries reachable only from HEAD.
         These dictionaries will be untouched.
   """
-  # This is O(N^2) computation, but it is okay for now since N is small.
+  # Index our commits by each key is_cherry_pick() matches on, so that every
+  # commit in their_commits is resolved with a few dictionary lookups instead
+  # of scanning all of our_commits. Each index maps to the position of the
+  # first matching commit in our_commits.
+  index_by_hash = {}
+  index_by_cherry_pick = {}
+  index_by_subject = {}
+  for index, our_commit in enumerate(our_commits):
+    index_by_hash.setdefault(our_commit['hash'], index)
+    for cherry_pick in _CHERRY_PICK_COMMENT_RE.findall(our_commit['body']):
+      index_by_cherry_pick.setdefault(cherry_pick, index)
+    index_by_subject.setdefault(simplify_subject(our_commit['subject']), index)
+
   for their_commit in their_commits:
-    for our_commit in our_commits:
-      if is_cherry_pick(their_commit, our_commit):
-        their_commit['cherry_pick_hash'] = our_commit['hash']
-        break
+    candidates = [
+        index_by_cherry_pick.get(their_commit['hash']),
+        index_by_subject.get(simplify_subject(their_commit['subject']))]
+    candidates.extend(
+        index_by_hash.get(cherry_pick) for cherry_pick in
+        _CHERRY_PICK_COMMENT_RE.findall(their_commit['body']))
+    candidates = [index for index in candidates if index is not None]
+    if candidates:
+      their_commit['cherry_pick_hash'] = our_commits[min(candidates)]['hash']
     else:
       their_commit['cherry_pick_hash'] = None
 
@@ -319,6 +486,9 @@ MERGE_HEAD=%(branch)s
 """ % {'branch': parsed_args.branch}
   subprocess.check_call(
       ['git', 'commit', '--allow-empty', '-m', commit_message])
+  start_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+  _save_merge_status({'start_hash': start_hash,
+                      'merge_head': parsed_args.branch})
 
   return handle_continue(parsed_args)
 
@@ -344,64 +514,75 @@ def handle_continue(parsed_args):
   check_target_branch_linearity_or_die(their_commits)
 
   mark_cherry_picks(their_commits, our_commits)
+  our_commits_by_hash = dict((c['hash'], c) for c in our_commits)
 
   while their_commits:
     num_remaining_commits = len(their_commits)
     commit = their_commits.pop(0)
-    clear_screen()
-    print '%d commit(s) to go. Next:' % num_remaining_commits
-    print
-    print '    === %s' % commit['hash']
-    print prepend_indent(commit['short_body'].strip(), 4)
-    print
+    # Build the whole screen first and write it at once.
+    screen = [
+        '%d commit(s) to go. Next:' % num_remaining_commits,
+        '',
+        '    === %s' % commit['hash'],
+        prepend_indent(commit['short_body'].strip(), 4),
+        '',
+    ]
 
     if commit['cherry_pick_hash']:
-      twin = get_commit(commit['cherry_pick_hash'])
-      print 'This commit has an apparent cherry-pick commit:'
-      print
-      print '    === %s' % commit['cherry_pick_hash']
-      print prepend_indent(twin['short_body'].strip(), 4)
-      print
-      print 'It is recommended to drop this commit.'
-      print
+      # The twin is always one of our_commits, so there is no need to run
+      # git-log again for it.
+      twin = our_commits_by_hash[commit['cherry_pick_hash']]
+      screen.extend([
+          'This commit has an apparent cherry-pick commit:',
+          '',
+          '    === %s' % commit['cherry_pick_hash'],
+          prepend_indent(twin['short_body'].strip(), 4),
+          '',
+          'It is recommended to drop this commit.',
+          '',
+      ])
       recommend = 'D'
     else:
-      print 'This commit has no known cherry-pick commit.'
-      print 'It is recommended to merge this commit.'
-      print
+      screen.extend([
+          'This commit has no known cherry-pick commit.',
+          'It is recommended to merge this commit.',
+          '',
+      ])
       recommend = 'M'
+    clear_screen()
+    print('\n'.join(screen))
 
     while True:
-      cmd = raw_input(
+      cmd = _input(
           'Action ([M]erge/[D]rop/[Q]uit; default=%s)? ' % recommend)
       cmd = cmd.strip().upper() or recommend
       if cmd == 'M':
         if run_git_merge(commit) != 0:
-          print
-          print 'If this conflict looks legitimate, please resolve it and'
-          print 'commit by git-commit.'
-          print
-          print 'Otherwise, you can revert the merge by:'
-          print '$ git reset --hard'
-          print
-          print 'After you resolved the state, continue the process by:'
-          print '$ %s continue' % sys.argv[0]
+          print()
+          print('If this conflict looks legitimate, please resolve it and')
+          print('commit by git-commit.')
+          print()
+          print('Otherwise, you can revert the merge by:')
+          print('$ git reset --hard')
+          print()
+          print('After you resolved the state, continue the process by:')
+          print('$ %s continue' % sys.argv[0])
           return 1
         break
       elif cmd == 'D':
         run_git_merge(commit, use_strategy_ours=True)
         break
       elif cmd == 'Q':
-        print 'You can continue the merge process by:'
-        print '$ %s continue' % sys.argv[0]
-        print 'Or if you want to abort the process:'
-        print '$ %s abort' % sys.argv[0]
+        print('You can continue the merge process by:')
+        print('$ %s continue' % sys.argv[0])
+        print('Or if you want to abort the process:')
+        print('$ %s abort' % sys.argv[0])
         return 0
 
-  print 'All commits merged!'
-  print
-  print 'Please run the following command to squash the merge commits:'
-  print '$ %s squash' % sys.argv[0]
+  print('All commits merged!')
+  print()
+  print('Please run the following command to squash the merge commits:')
+  print('$ %s squash' % sys.argv[0])
 
 
 def handle_squash(parsed_args):
@@ -434,15 +615,16 @@ def handle_squash(parsed_args):
   with open('.git/MERGE_HEAD', 'w') as f:
     f.write(status['merge_head'])
   subprocess.check_call(['git', 'commit', '-m', merge_log])
+  _clear_merge_status()
 
-  print
-  print 'Squashed the merge commits to a single merge commit.'
-  print
-  print 'Please complete the commit message by:'
-  print '$ git commit --amend'
-  print
-  print 'Afterwards, please test the commit and send it for review.'
-  print 'Have a good day!'
+  print()
+  print('Squashed the merge commits to a single merge commit.')
+  print()
+  print('Please complete the commit message by:')
+  print('$ git commit --amend')
+  print()
+  print('Afterwards, please test the commit and send it for review.')
+  print('Have a good day!')
 
 
 def handle_abort(parsed_args):
@@ -455,9 +637,10 @@ def handle_abort(parsed_args):
 
   subprocess.check_call(
       ['git', 'reset', '--hard', '%s~' % status['start_hash']])
+  _clear_merge_status()
 
-  print
-  print 'Aborted the incremental merge process.'
+  print()
+  print('Aborted the incremental merge process.')
 
 
 def create_parser():
@@ -0,0 +1,83 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import unittest
+
+from src.build import incremental_merge
+
+
+def _make_commit(commit_hash, subject, body=''):
+  return {'hash': commit_hash, 'subject': subject,
+          'body': subject + '\n' + body}
+
+
+class IncrementalMergeTest(unittest.TestCase):
+  def test_prepend_indent(self):
+    self.assertEqual('', incremental_merge.prepend_indent('', 4))
+    self.assertEqual('    a', incremental_merge.prepend_indent('a', 4))
+    self.assertEqual('  a\n  \n  b',
+                     incremental_merge.prepend_indent('a\n\nb\n', 2))
+
+  def test_simplify_subject(self):
+    self.assertEqual('Fix foo', incremental_merge.simplify_subject('Fix foo'))
+    self.assertEqual('Fix foo',
+                     incremental_merge.simplify_subject(' lol5: Fix foo'))
+    self.assertEqual('Fix foo',
+                     incremental_merge.simplify_subject('L-Rebase: Fix foo'))
+    self.assertEqual('Reland: Fix foo',
+                     incremental_merge.simplify_subject('Reland: Fix foo'))
+
+  def test_mark_cherry_picks(self):
+    ours = [
+        _make_commit('a1', 'Unrelated'),
+        _make_commit('a2', 'Picked',
+                     '(cherry picked from commit b1)'),
+        _make_commit('a3', 'lol5: Same subject'),
+        _make_commit('a4', 'Picked by them'),
+    ]
+    theirs = [
+        _make_commit('b1', 'Picked'),
+        _make_commit('b2', 'Same subject'),
+        _make_commit('b3', 'Picked from us',
+                     '(cherry picked from commit a4)'),
+        _make_commit('b4', 'Not picked'),
+    ]
+    incremental_merge.mark_cherry_picks(theirs, ours)
+    self.assertEqual(['a2', 'a3', 'a4', None],
+                     [c['cherry_pick_hash'] for c in theirs])
+    # Our commits must be untouched.
+    self.assertTrue(all('cherry_pick_hash' not in c for c in ours))
+
+  def test_mark_cherry_picks_prefers_first_match(self):
+    # Both a1 (by subject) and a2 (by cherry-pick comment) match b1. As with
+    # is_cherry_pick() on each of our commits in order, the first one wins.
+    ours = [
+        _make_commit('a1', 'Fix foo'),
+        _make_commit('a2', 'Something else',
+                     '(cherry picked from commit b1)'),
+    ]
+    theirs = [_make_commit('b1', 'Fix foo')]
+    incremental_merge.mark_cherry_picks(theirs, ours)
+    self.assertEqual('a1', theirs[0]['cherry_pick_hash'])
+
+    ours.reverse()
+    incremental_merge.mark_cherry_picks(theirs, ours)
+    self.assertEqual('a2', theirs[0]['cherry_pick_hash'])
+
+  def test_parse_log_chunk(self):
+    commit = incremental_merge.parse_log_chunk(
+        'c0ffee\np1 p2\nfoo@example.com\nSubject\n\nDetails.\n\n'
+        'TEST=none\nReviewed-on: https://example.com/1\n'
+        'Reviewed-on: https://example.com/2\n')
+    self.assertEqual('c0ffee', commit['hash'])
+    self.assertEqual(['p1', 'p2'], commit['parents'])
+    self.assertEqual('foo@example.com', commit['author'])
+    self.assertEqual('Subject', commit['subject'])
+    self.assertEqual(
+        'Subject\n\nDetails.\n\nReviewed-on: https://example.com/2\n',
+        commit['short_body'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -4,21 +4,22 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-import Queue
 import argparse
 import ast
 import collections
 import contextlib
+import json
 import logging
 import os
 import random
-import re
 import subprocess
 import sys
+import tempfile
 import threading
 
 from src.build import build_common
 from src.build.build_options import OPTIONS
+from src.build.util import concurrent
 from src.build.util import concurrent_subprocess
 from src.build.util import logging_util
 from src.build.util import statistics
@@ -31,8 +32,55 @@ _TEST_SSH_KEY = (
     'third_party/tools/crosutils/mod_for_test_scripts/ssh_keys/testing_rsa')
 
 # File name pattern used for ssh connection sharing (%r: remote login name,
-# %h: host name, and %p: port). See man ssh_config for the detail.
-_SSH_CONTROL_PATH = '/tmp/perftest-ssh-%r@%h:%p'
+# %h: host name, and %p: port). See man ssh_config for the detail. {instance_id}
+# is replaced with InteractivePerfTestRunner's instance_id, so that each
+# runner owns its master connection.
+_SSH_CONTROL_PATH = '/tmp/perftest-ssh-{instance_id}-%r@%h:%p'
+
+# Prefix of the launch_chrome perftest output line which contains the raw
+# perf values.
+_VRAWPERF_PREFIX = 'VRAWPERF='
+
+# launch_chrome perftest outputs a line containing this when it gets ready for
+# the next iteration.
+_ITERATION_READY_MARKER = 'waiting for next iteration'
+
+# rsync filter rules to copy the files needed to run perftest to the stash
+# directory. {out} and {target} are replaced with the output directory and
+# the target directory name. See FILTER RULES section in rsync manpages for
+# syntax.
+_STASH_RSYNC_RULE_TEMPLATES = [
+    # No git repo.
+    '- .git/',
+    # Artifacts for the target arch and common.
+    '+ /{out}/target/{target}/runtime/',
+    '+ /{out}/target/{target}/unittest_info/',
+    '- /{out}/target/{target}/*',
+    '+ /{out}/target/{target}/',
+    '+ /{out}/target/common/',
+    '- /{out}/target/*',
+    '- /{out}/staging/',
+    # No internal-apks build artifacts.
+    '- /{out}/gms-core-build/',
+    '- /{out}/google-contacts-sync-adapter-build/',
+    '+ /{out}/',
+    '+ /src/',
+    # aapt etc.
+    '+ /third_party/android-sdk/',
+    # ninja etc.
+    '+ /third_party/tools/ninja/',
+    '+ /third_party/tools/crosutils/mod_for_test_scripts/ssh_keys/',
+    '- /third_party/tools/crosutils/mod_for_test_scripts/*',
+    '+ /third_party/tools/crosutils/mod_for_test_scripts/',
+    '- /third_party/tools/crosutils/*',
+    '+ /third_party/tools/crosutils/',
+    '- /third_party/tools/*',
+    '+ /third_party/tools/',
+    '- /third_party/*',
+    '+ /third_party/',
+    '+ /launch_chrome',
+    '- /*',
+]
 
 
 def get_abs_arc_root():
@@ -117,6 +165,12 @@ Typical usage:
       '--remote', metavar='<HOST>',
       help=('The host name of the Chrome OS remote host to run perftest on. '
             'Other OSs are not currently supported.'))
+  compare_parser.add_argument(
+      '--parallel-runners', action='store_true',
+      help=('Run the control and experiment perftest iterations at the same '
+            'time. This roughly halves the wall time, but use it only if the '
+            'two runs do not interfere with each other, e.g. on a machine '
+            'with enough idle cores.'))
   compare_parser.set_defaults(entrypoint=handle_compare)
 
   clean_parser = subparsers.add_parser(
@@ -157,33 +211,51 @@ def load_configure_options(arc_root):
     return f.read().strip()
 
 
+def _parse_vrawperf(payload):
+  """Parses the VRAWPERF payload, which is a dict of lists of numbers.
+
+  launch_chrome prints the payload as JSON, which json.loads() parses much
+  faster than ast.literal_eval(). A stashed control tree may be older and
+  print the repr() of the dict instead, so fall back to ast.literal_eval().
+  """
+  try:
+    # Convert the keys back from unicode so the merged results print the same
+    # as before.
+    return dict((str(key), values)
+                for key, values in json.loads(payload).iteritems())
+  except ValueError:
+    return ast.literal_eval(payload)
+
+
 class _InteractivePerfTestOutputHandler(concurrent_subprocess.OutputHandler):
   """Output handler for InteractivePerfTestRunner."""
 
-  def __init__(self, iteration_ready_event, vrawperf_queue):
+  def __init__(self, iteration_ready_event, put_vrawperf):
     super(_InteractivePerfTestOutputHandler, self).__init__()
     self._iteration_ready_event = iteration_ready_event
-    self._vrawperf_queue = vrawperf_queue
+    self._put_vrawperf = put_vrawperf
 
   def handle_stdout(self, line):
     sys.stdout.write(line)
     sys.stdout.flush()
-    return self._handle_common(line)
+    # The output is passed line by line, so a prefix check is enough to find
+    # the VRAWPERF line without scanning the whole line by a regex.
+    if line.startswith(_VRAWPERF_PREFIX):
+      self._put_vrawperf(
+          _parse_vrawperf(line[len(_VRAWPERF_PREFIX):].rstrip('\r\n')))
+    else:
+      # launch_chrome writes the marker to stderr, but it is merged into
+      # stdout when running on a remote machine with a pseudo tty.
+      self._handle_iteration_ready_marker(line)
 
   def handle_stderr(self, line):
     sys.stderr.write(line)
     sys.stderr.flush()
-    return self._handle_common(line)
-
-  def _handle_common(self, line):
-    m = re.search(r'^VRAWPERF=(.*)', line)
-    if m:
-      # block=False triggers the Queue.Full if the queue is not empty.
-      # See also the comment in
-      # _InteractivePerfTestLaunchChromeThread.__init__().
-      self._vrawperf_queue.put(ast.literal_eval(m.group(1)), block=False)
-    m = re.search(r'waiting for next iteration', line)
-    if m:
+    # VRAWPERF is printed only to stdout, so just look for the marker.
+    self._handle_iteration_ready_marker(line)
+
+  def _handle_iteration_ready_marker(self, line):
+    if _ITERATION_READY_MARKER in line:
       self._iteration_ready_event.set()
 
 
@@ -202,9 +274,11 @@ class _InteractivePerfTestLaunchChromeThread(threading.Thread):
     self._args = args
     self._cwd = cwd
     self._iteration_ready_event = threading.Event()
-    # We set |maxsize| to 1, expecting that the VRAMPERF is read by the
-    # main thread, before we run the next iteration.
-    self._vrawperf_queue = Queue.Queue(maxsize=1)
+    # A single slot to hand the VRAWPERF over to the main thread. We expect
+    # that the VRAWPERF is read by the main thread before we run the next
+    # iteration, so a slot is enough and cheaper than a Queue.
+    self._vrawperf_ready_event = threading.Event()
+    self._vrawperf = None
 
     # It is necessary to guard |self._terminated| and |self._process| to be
     # thread safe, which is touched by both run() invoked on the dedicated
@@ -212,33 +286,55 @@ class _InteractivePerfTestLaunchChromeThread(threading.Thread):
     self._lock = threading.Lock()
     self._terminated = False
     self._process = None
+    # Set when ./launch_chrome exits, so that the waiting main thread wakes
+    # up immediately instead of waiting for output which never comes.
+    self._exited = False
 
   def run(self):
     # Overrides threading.Thread.run()
     output_handler = _InteractivePerfTestOutputHandler(
-        self._iteration_ready_event, self._vrawperf_queue)
-    with self._lock:
-      if self._terminated:
-        return
-      self._process = concurrent_subprocess.Popen(self._args, cwd=self._cwd)
-    self._process.handle_output(output_handler)
+        self._iteration_ready_event, self._put_vrawperf)
+    try:
+      with self._lock:
+        if self._terminated:
+          return
+        self._process = concurrent_subprocess.Popen(self._args, cwd=self._cwd)
+      self._process.handle_output(output_handler)
+    finally:
+      self._exited = True
+      self._iteration_ready_event.set()
+      self._vrawperf_ready_event.set()
 
   def wait_iteration_ready(self):
     """Waits until "waiting for next iteration" is read."""
     self._iteration_ready_event.wait()
     self._iteration_ready_event.clear()
+    if self._exited:
+      raise Exception('launch_chrome exited before the next iteration.')
 
   def read_vrawperf(self):
     """Reads VRAMPERF line from ./launch_chrome output.
 
     This blocks until VRAMPERF line is output by ./launch_chrome.
     """
-    # Queue.get() does not abort on Ctrl-C unless some timeout is set (see:
+    # Event.wait() does not abort on Ctrl-C unless some timeout is set (see:
     # http://bugs.python.org/issue1360.) We put long (1h) timeout to workaround.
-    result = self._vrawperf_queue.get(True, 60 * 60)
-    self._vrawperf_queue.task_done()
+    self._vrawperf_ready_event.wait(60 * 60)
+    result = self._vrawperf
+    self._vrawperf = None
+    self._vrawperf_ready_event.clear()
+    if result is None:
+      if self._exited:
+        raise Exception('launch_chrome exited before printing VRAWPERF.')
+      raise Exception('Timed out waiting for VRAWPERF.')
     return result
 
+  def _put_vrawperf(self, vrawperf):
+    """Hands |vrawperf| over to read_vrawperf(). Called on this thread."""
+    assert self._vrawperf is None, 'The previous VRAWPERF has not been read.'
+    self._vrawperf = vrawperf
+    self._vrawperf_ready_event.set()
+
   def terminate(self):
     """Tries to terminate the ./launch_chrome process.
 
@@ -294,6 +390,8 @@ class InteractivePerfTestRunner(object):
     user = os.getenv('USER', 'default')
     self._iteration_lock_file = '/var/tmp/arc-iteration-lock-%s-%d' % (
         user, instance_id)
+    self._ssh_control_path = _SSH_CONTROL_PATH.format(instance_id=instance_id)
+    self._ssh_master_started = False
     self._thread = None
 
   def start(self):
@@ -324,6 +422,9 @@ class InteractivePerfTestRunner(object):
         args.append('--no-remote-machine-setup')
     args.extend(self._launch_chrome_opts)
 
+    if self._remote:
+      self._start_ssh_master()
+
     # Remove the lock file in case it's left.
     self._remove_iteration_lock_file()
 
@@ -354,34 +455,55 @@ class InteractivePerfTestRunner(object):
 
   def close(self):
     """Terminates launch_chrome."""
-    if not self._thread:
-      return
-
-    # Terminates ./launch_chrome process, which eventually terminates
-    # the dedicated thread.
-    self._thread.terminate()
-    self._thread.join()
-    self._thread = None
+    if self._thread:
+      # Terminates ./launch_chrome process, which eventually terminates
+      # the dedicated thread.
+      self._thread.terminate()
+      self._thread.join()
+      self._thread = None
+
+    if self._ssh_master_started:
+      args = self._get_ssh_args() + ['-O', 'exit', 'root@%s' % self._remote]
+      logging.info('$ %s',
+                   logging_util.format_commandline(args, cwd=self._arc_root))
+      subprocess.call(args, cwd=self._arc_root)
+      self._ssh_master_started = False
+
+  def _get_ssh_args(self):
+    """Returns the ssh command line sharing this runner's connection."""
+    return [
+        'ssh',
+        '-o', 'StrictHostKeyChecking=no',
+        '-o', 'UserKnownHostsFile=/dev/null',
+        '-o', 'PasswordAuthentication=no',
+        '-o', 'ControlPath=%s' % self._ssh_control_path,
+        '-i', _TEST_SSH_KEY]
+
+  def _start_ssh_master(self):
+    """Opens the master ssh connection to the remote machine.
+
+    The connection is kept open in background until close(), so that each
+    iteration's ssh invocation skips the connection setup.
+    """
+    os.chmod(os.path.join(self._arc_root, _TEST_SSH_KEY), 0600)
+    args = self._get_ssh_args() + ['-M', '-N', '-f', 'root@%s' % self._remote]
+    logging.info('$ %s',
+                 logging_util.format_commandline(args, cwd=self._arc_root))
+    subprocess.check_call(args, cwd=self._arc_root)
+    self._ssh_master_started = True
 
   def _remove_iteration_lock_file(self):
     """Removes the iteration lock file, possibly on remote machine."""
     if self._remote:
-      args = [
-          'ssh',
-          '-o', 'StrictHostKeyChecking=no',
-          '-o', 'UserKnownHostsFile=/dev/null',
-          '-o', 'PasswordAuthentication=no',
-          '-o', 'ControlMaster=auto',
-          '-o', 'ControlPersist=60s',
-          '-o', 'ControlPath=%s' % _SSH_CONTROL_PATH,
-          '-i', _TEST_SSH_KEY,
-          'root@%s' % self._remote]
-      os.chmod(os.path.join(self._arc_root, _TEST_SSH_KEY), 0600)
+      args = self._get_ssh_args() + ['root@%s' % self._remote]
     else:
       args = ['bash', '-c']
     args.append('rm -f "%s"' % self._iteration_lock_file)
-    logging.info('$ %s',
-                 logging_util.format_commandline(args, cwd=self._arc_root))
+    # This runs on every iteration, so log it only with --verbose, and skip
+    # formatting the command line otherwise.
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      logging.debug('$ %s',
+                    logging_util.format_commandline(args, cwd=self._arc_root))
     subprocess.check_call(args, cwd=self._arc_root)
 
 
@@ -401,7 +523,41 @@ def bootstrap_sample(sample):
     A Bootstrap sample as a list of numbers. The size of the returned Bootstrap
     sample is equal to that of the original sample.
   """
-  return [random.choice(sample) for _ in sample]
+  # Draw the indices directly, which avoids the per-element function call
+  # overhead of random.choice().
+  rand = random.random
+  n = len(sample)
+  return [sample[int(rand() * n)] for _ in xrange(n)]
+
+
+def _bootstrap_medians(sample, count):
+  """Computes medians of |count| Bootstrap samples of |sample|.
+
+  Instead of materializing each Bootstrap sample, this draws the indices into
+  the sorted original sample and sorts them. As the original sample is sorted,
+  the median of a Bootstrap sample is found at the median of its sorted
+  indices, so no sample values are copied or compared.
+
+  Args:
+    sample: A sample as a list of numbers.
+    count: The number of Bootstrap samples.
+
+  Returns:
+    A list of |count| medians.
+  """
+  values = sorted(sample)
+  n = len(values)
+  if not n:
+    return [float('NaN')] * count
+  lower = (n - 1) / 2
+  upper = n / 2
+  rand = random.random
+  indices_range = xrange(n)
+  medians = []
+  for _ in xrange(count):
+    indices = sorted([int(rand() * n) for _ in indices_range])
+    medians.append((values[indices[lower]] + values[indices[upper]]) * 0.5)
+  return medians
 
 
 def bootstrap_estimation(
@@ -418,15 +574,81 @@ def bootstrap_estimation(
   Returns:
     Estimated range as a number tuple.
   """
-  bootstrap_distribution = []
-  for _ in xrange(1000):
-    bootstrap_distribution.append(
+  if statistic is statistics.compute_median:
+    bootstrap_distribution = [
+        expt - ctrl for expt, ctrl in zip(
+            _bootstrap_medians(expt_sample, 1000),
+            _bootstrap_medians(ctrl_sample, 1000))]
+  else:
+    bootstrap_distribution = [
         statistic(bootstrap_sample(expt_sample)) -
-        statistic(bootstrap_sample(ctrl_sample)))
+        statistic(bootstrap_sample(ctrl_sample))
+        for _ in xrange(1000)]
   return statistics.compute_percentiles(
       bootstrap_distribution, (100 - confidence_level, confidence_level))
 
 
+def bootstrap_median_estimations(
+    ctrl_samples, expt_samples, confidence_level):
+  """Estimates confidence intervals of differences of medians by Bootstrap.
+
+  Unlike bootstrap_estimation(), the same Bootstrap resampling of iterations
+  is shared by all the samples, as the i-th values of all the samples come
+  from the same perftest iteration. This draws the random indices only once
+  for all metrics.
+
+  Args:
+    ctrl_samples: A list of control samples, each as a list of numbers.
+    expt_samples: A list of experiment samples, each as a list of numbers.
+    confidence_level: An integer that specifies requested confidence level
+        in percentage, e.g. 90, 95, 99.
+
+  Returns:
+    A list of estimated ranges as number tuples, one for each pair of samples.
+  """
+  samples = ctrl_samples + expt_samples
+  n = len(samples[0]) if samples else 0
+  if not n or any(len(sample) != n for sample in samples):
+    return [bootstrap_estimation(ctrl_sample, expt_sample,
+                                 statistics.compute_median, confidence_level)
+            for ctrl_sample, expt_sample in zip(ctrl_samples, expt_samples)]
+
+  # As in _bootstrap_medians(), the median of a Bootstrap sample is computed
+  # from the sorted ranks of the drawn values in the original sample.
+  sorted_samples = []
+  ranks_list = []
+  for sample in samples:
+    order = sorted(xrange(n), key=sample.__getitem__)
+    ranks = [0] * n
+    for rank, index in enumerate(order):
+      ranks[index] = rank
+    sorted_samples.append([sample[index] for index in order])
+    ranks_list.append(ranks)
+
+  lower = (n - 1) / 2
+  upper = n / 2
+  rand = random.random
+  indices_range = xrange(n)
+  medians_list = [[] for _ in samples]
+  for _ in xrange(1000):
+    indices = [int(rand() * n) for _ in indices_range]
+    for values, ranks, medians in zip(
+        sorted_samples, ranks_list, medians_list):
+      drawn_ranks = sorted([ranks[index] for index in indices])
+      medians.append(
+          (values[drawn_ranks[lower]] + values[drawn_ranks[upper]]) * 0.5)
+
+  num_ctrl = len(ctrl_samples)
+  result = []
+  for ctrl_medians, expt_medians in zip(medians_list[:num_ctrl],
+                                        medians_list[num_ctrl:]):
+    bootstrap_distribution = [
+        expt - ctrl for expt, ctrl in zip(expt_medians, ctrl_medians)]
+    result.append(statistics.compute_percentiles(
+        bootstrap_distribution, (100 - confidence_level, confidence_level)))
+  return result
+
+
 def handle_stash(parsed_args):
   """The entry point for stash command.
 
@@ -443,59 +665,30 @@ def handle_stash(parsed_args):
   if parsed_args.run_ninja:
     build_common.run_ninja()
 
-  # See FILTER RULES section in rsync manpages for syntax.
-  rules_text = """
-  # No git repo.
-  - .git/
-  # Artifacts for the target arch and common.
-  + /{out}/target/{target}/runtime/
-  + /{out}/target/{target}/unittest_info/
-  - /{out}/target/{target}/*
-  + /{out}/target/{target}/
-  + /{out}/target/common/
-  - /{out}/target/*
-  - /{out}/staging/
-  # No internal-apks build artifacts.
-  - /{out}/gms-core-build/
-  - /{out}/google-contacts-sync-adapter-build/
-  + /{out}/
-  + /src/
-  # aapt etc.
-  + /third_party/android-sdk/
-  # ninja etc.
-  + /third_party/tools/ninja/
-  + /third_party/tools/crosutils/mod_for_test_scripts/ssh_keys/
-  - /third_party/tools/crosutils/mod_for_test_scripts/*
-  + /third_party/tools/crosutils/mod_for_test_scripts/
-  - /third_party/tools/crosutils/*
-  + /third_party/tools/crosutils/
-  - /third_party/tools/*
-  + /third_party/tools/
-  - /third_party/*
-  + /third_party/
-  + /launch_chrome
-  - /*
-  """.format(
-      out=build_common.OUT_DIR,
-      target=build_common.get_target_dir_name())
-
-  rules = []
-  for line in rules_text.strip().splitlines():
-    line = line.strip()
-    if line and not line.startswith('#'):
-      rules.append(line)
-
-  args = ['rsync', '-a', '--delete', '--delete-excluded', '--copy-links']
-  if parsed_args.verbose:
-    args.append('-v')
-  args.extend(['--filter=%s' % rule for rule in rules])
-  # A trailing dot is required to make rsync work as we expect.
-  args.extend([os.path.join(arc_root, '.'), stash_root])
-
-  logging.info(
-      'running rsync to copy the arc tree to %s. please be patient...',
-      stash_root)
-  subprocess.check_call(args)
+  rules = [rule.format(out=build_common.OUT_DIR,
+                       target=build_common.get_target_dir_name())
+           for rule in _STASH_RSYNC_RULE_TEMPLATES]
+
+  # Pass the rules in a merge file so rsync reads them at once, rather than
+  # as one command line option per rule.
+  with tempfile.NamedTemporaryFile(prefix='rsync-rules-') as rules_file:
+    rules_file.write('\n'.join(rules) + '\n')
+    rules_file.flush()
+
+    # The stash is on the local file system, so copy changed files whole and
+    # write them in place, skipping the delta algorithm and temporary files.
+    args = ['rsync', '-a', '--delete', '--delete-excluded', '--copy-links',
+            '--whole-file', '--inplace']
+    if parsed_args.verbose:
+      args.append('-v')
+    args.append('--filter=merge %s' % rules_file.name)
+    # A trailing dot is required to make rsync work as we expect.
+    args.extend([os.path.join(arc_root, '.'), stash_root])
+
+    logging.info(
+        'running rsync to copy the arc tree to %s. please be patient...',
+        stash_root)
+    subprocess.check_call(args)
 
   logging.info('stashed the arc tree at %s.', stash_root)
 
@@ -511,6 +704,31 @@ def handle_clean(parsed_args):
   subprocess.check_call(args)
 
 
+def _format_metric(prefix, unit, frac_digits, ctrl_median, expt_median,
+                   diff_estimate_lower, diff_estimate_upper):
+  """Formats a line of the comparison result of a metric."""
+  def format_frac(k, sign=False):
+    format_string = '%'
+    if sign:
+      format_string += '+'
+    format_string += '.%d' % frac_digits
+    format_string += 'f'
+    return (format_string % k) + unit
+  if diff_estimate_upper < 0:
+    significance = '[--]'
+  elif diff_estimate_lower > 0:
+    significance = '[++]'
+  else:
+    significance = '[not sgfnt.]'
+  return '     %s: ctrl=%s, expt=%s, diffCI=(%s,%s) %s' % (
+      prefix,
+      format_frac(ctrl_median),
+      format_frac(expt_median),
+      format_frac(diff_estimate_lower, sign=True),
+      format_frac(diff_estimate_upper, sign=True),
+      significance)
+
+
 def handle_compare(parsed_args):
   """The entry point for compare command.
 
@@ -565,65 +783,74 @@ def handle_compare(parsed_args):
     def do_expt():
       merge_perfs(expt_perfs, expt_runner.run())
 
-    for iteration in xrange(parsed_args.iterations):
-      print
-      print '=================================== iteration %d/%d' % (
-          iteration + 1, parsed_args.iterations)
-      for do in random.sample((do_ctrl, do_expt), 2):
-        do()
-
-  print
-  print 'VRAWPERF_CTRL=%r' % dict(ctrl_perfs)  # Convert from defaultdict.
-  print 'VRAWPERF_EXPT=%r' % dict(expt_perfs)  # Convert from defaultdict.
-  print
-  print 'PERF=runs=%d CI=%d%%' % (
-      parsed_args.iterations, parsed_args.confidence_level)
+    executor = None
+    if parsed_args.parallel_runners:
+      # The runners mostly wait for launch_chrome output, so threads are
+      # enough to overlap them. The same two workers serve all iterations.
+      executor = concurrent.ThreadPoolExecutor(max_workers=2, daemon=True)
+    try:
+      for iteration in xrange(parsed_args.iterations):
+        print
+        print '=================================== iteration %d/%d' % (
+            iteration + 1, parsed_args.iterations)
+        if executor:
+          done, not_done = concurrent.wait(
+              [executor.submit(do_ctrl), executor.submit(do_expt)],
+              return_when=concurrent.FIRST_EXCEPTION)
+          for future in done:
+            # This re-raises the exception from the runner, if any.
+            future.result()
+        elif random.random() < 0.5:
+          do_ctrl()
+          do_expt()
+        else:
+          do_expt()
+          do_ctrl()
+    finally:
+      if executor:
+        # Do not wait for a runner blocked in run(). It is terminated on
+        # closing the runners.
+        executor.shutdown(wait=False)
+
+  # (prefix, key, unit, frac_digits)
+  metrics = [
+      ('boot', 'boot_time_ms', 'ms', 0),
+      ('  preEmbed', 'pre_embed_time_ms', 'ms', 0),
+      ('  pluginLoad', 'plugin_load_time_ms', 'ms', 0),
+      ('  onResume', 'on_resume_time_ms', 'ms', 0),
+      ('virt', 'app_virt_mem', 'MB', 1),
+      ('res', 'app_res_mem', 'MB', 1),
+      ('pdirt', 'app_pdirt_mem', 'MB', 1),
+  ]
+  ctrl_samples = [ctrl_perfs[key] for _, key, _, _ in metrics]
+  expt_samples = [expt_perfs[key] for _, key, _, _ in metrics]
+  diff_estimates = bootstrap_median_estimations(
+      ctrl_samples, expt_samples, parsed_args.confidence_level)
+
+  # Build the whole report first, and write it at once.
+  lines = [
+      '',
+      'VRAWPERF_CTRL=%r' % dict(ctrl_perfs),  # Convert from defaultdict.
+      'VRAWPERF_EXPT=%r' % dict(expt_perfs),  # Convert from defaultdict.
+      '',
+      'PERF=runs=%d CI=%d%%' % (
+          parsed_args.iterations, parsed_args.confidence_level)]
   if expt_options == ctrl_options:
-    print '     configure_opts=%s' % expt_options
+    lines.append('     configure_opts=%s' % expt_options)
   else:
-    print '     configure_opts=%s (vs. %s)' % (expt_options, ctrl_options)
-  print '     launch_chrome_opts=%s' % ' '.join(parsed_args.launch_chrome_opt)
-
-  def _print_metric(prefix, key, unit, frac_digits=0):
-    def format_frac(k, sign=False):
-      format_string = '%'
-      if sign:
-        format_string += '+'
-      format_string += '.%d' % frac_digits
-      format_string += 'f'
-      return (format_string % k) + unit
-    ctrl_sample = ctrl_perfs[key]
-    expt_sample = expt_perfs[key]
-    ctrl_median = statistics.compute_median(ctrl_sample)
-    expt_median = statistics.compute_median(expt_sample)
-    diff_estimate_lower, diff_estimate_upper = (
-        bootstrap_estimation(
-            ctrl_sample, expt_sample,
-            statistics.compute_median,
-            parsed_args.confidence_level))
-    if diff_estimate_upper < 0:
-      significance = '[--]'
-    elif diff_estimate_lower > 0:
-      significance = '[++]'
-    else:
-      significance = '[not sgfnt.]'
-    print '     %s: ctrl=%s, expt=%s, diffCI=(%s,%s) %s' % (
-        prefix,
-        format_frac(ctrl_median),
-        format_frac(expt_median),
-        format_frac(diff_estimate_lower, sign=True),
-        format_frac(diff_estimate_upper, sign=True),
-        significance)
-
-  _print_metric('boot', 'boot_time_ms', 'ms')
-  _print_metric('  preEmbed', 'pre_embed_time_ms', 'ms')
-  _print_metric('  pluginLoad', 'plugin_load_time_ms', 'ms')
-  _print_metric('  onResume', 'on_resume_time_ms', 'ms')
-  _print_metric('virt', 'app_virt_mem', 'MB', frac_digits=1)
-  _print_metric('res', 'app_res_mem', 'MB', frac_digits=1)
-  _print_metric('pdirt', 'app_pdirt_mem', 'MB', frac_digits=1)
-
-  print '     (see go/arcipt for how to interpret these numbers)'
+    lines.append(
+        '     configure_opts=%s (vs. %s)' % (expt_options, ctrl_options))
+  lines.append(
+      '     launch_chrome_opts=%s' % ' '.join(parsed_args.launch_chrome_opt))
+  for i, (prefix, _, unit, frac_digits) in enumerate(metrics):
+    diff_estimate_lower, diff_estimate_upper = diff_estimates[i]
+    lines.append(_format_metric(
+        prefix, unit, frac_digits,
+        statistics.compute_median(ctrl_samples[i]),
+        statistics.compute_median(expt_samples[i]),
+        diff_estimate_lower, diff_estimate_upper))
+  lines.append('     (see go/arcipt for how to interpret these numbers)')
+  sys.stdout.write('\n'.join(lines) + '\n')
 
 
 def main():
@@ -5,9 +5,14 @@
 # found in the LICENSE file.
 
 import atexit
+import contextlib
+import ctypes
+import errno
+import fcntl
 import logging
 import os
 import re
+import select
 import signal
 import subprocess
 import sys
@@ -40,74 +45,214 @@ _CHROME_KILL_DELAY = 0.1
 
 _CHROME_KILL_TIMEOUT = 10
 
+# Linux system call numbers of pidfd_open(2) and pidfd_send_signal(2). They are
+# the same on all architectures, as they were added after the system call
+# tables were unified.
+_SYS_PIDFD_SEND_SIGNAL = 424
+_SYS_PIDFD_OPEN = 434
+
+# inotify constants from <sys/inotify.h>.
+_IN_CLOEXEC = 02000000
+_IN_MOVED_FROM = 0x40
+_IN_DELETE = 0x200
+
 _CHROME_PID_PATH = None
 
 _PERF_TOOL = 'perf'
 
 _USER_DATA_DIR = None  # Will be set after we parse the commandline flags.
 
+# Cached results of _get_chrome_path() and _get_nacl_irt_path(). They do not
+# change during a run, but are queried on every perftest iteration.
+_CHROME_PATH = None
+_NACL_IRT_PATH = None
+
+# The command line to launch Chrome, which is the same for all iterations.
+_CHROME_PARAMS = None
+
+# Params that are necessary for stable perftest result.
+_CHROME_PERFORMANCE_TEST_PARAMS = (
+    # Skip First Run tasks, whether or not it's actually the First Run.
+    '--no-first-run',
+
+    # Disable default component extensions with background pages - useful for
+    # performance tests where these pages may interfere with perf results.
+    '--disable-component-extensions-with-background-pages',
+
+    # Enable the recording of metrics reports but disable reporting. In
+    # contrast to kDisableMetrics, this executes all the code that a normal
+    # client would use for reporting, except the report is dropped rather than
+    # sent to the server. This is useful for finding issues in the metrics code
+    # during UI and performance tests.
+    '--metrics-recording-only',
+
+    # Disable several subsystems which run network requests in the background.
+    # This is for use when doing network performance testing to avoid noise in
+    # the measurements.
+    '--disable-background-networking',
+
+    # They are copied from
+    #  ppapi/native_client/tools/browser_tester/browsertester/browserlauncher.py
+    # These features could be a source of non-determinism too.
+    '--disable-default-apps',
+    '--disable-preconnect',
+    '--disable-sync',
+    '--disable-web-resources',
+    '--dns-prefetch-disable',
+    '--no-default-browser-check',
+    '--safebrowsing-disable-auto-update',
+)
+
 # List of lines for stdout/stderr Chrome output to suppress.
 _SUPPRESS_LIST = [
     # When debugging with gdb, NaCl is emitting many of these messages.
     'NaClAppThreadSetSuspendedRegisters: Registers not modified',
 ]
 
+# A regex matching any line containing one of |_SUPPRESS_LIST|. A single
+# leading '.*' lets the regex engine scan each line once for all of them.
+_SUPPRESS_PATTERN = '.*(?:%s)' % '|'.join(
+    re.escape(suppress) for suppress in _SUPPRESS_LIST)
+
 
-# Caution: The feature to kill the running chrome has race condition, that this
-# may kill unrelated process. The file can be rewritten at anytime, so there
-# is no simpler way to guarantee that the pid read from the file is reliable.
-# Note that technically we should be able to lock the file, but python does
-# not provide portable implementation.
+@contextlib.contextmanager
+def _chrome_pid_file_lock():
+  """Serializes accesses to chrome.pid among launch_chrome processes.
+
+  The lock is taken on a separate file, because chrome.pid itself is removed
+  while the lock is held.
+  """
+  with open(_CHROME_PID_PATH + '.lock', 'a') as lock_file:
+    # The lock is released when the file is closed.
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    yield
+
+
+# Caution: The feature to kill the running chrome may still kill an unrelated
+# process, if Chrome exited without removing the file and its pid is reused.
+# The file itself is only read and written under _chrome_pid_file_lock(), so
+# it cannot be rewritten between reading the pid and killing the process.
 def _read_chrome_pid_file():
   if not os.path.exists(_CHROME_PID_PATH):
     return None
 
+  # The file contains only a pid and a newline, so a bounded read is enough
+  # even if the file happens to be corrupted.
   with open(_CHROME_PID_PATH) as pid_file:
-    lines = pid_file.readlines()
-  if not lines:
+    content = pid_file.read(32)
+  if not content:
     logging.error('chrome.pid is empty.')
     return None
+  line = content.split('\n', 1)[0]
   try:
-    return int(lines[0])
+    return int(line)
   except ValueError:
-    logging.error('Invalid content of chrome.pid: ' + lines[0])
+    logging.error('Invalid content of chrome.pid: ' + line)
     return None
 
 
+def _open_pidfd(pid):
+  """Returns a pidfd referring to the process |pid|.
+
+  Returns None if a pidfd is not available, e.g. not on Linux 5.3 or later,
+  or the syscall is rejected by a seccomp filter. The caller should fall back
+  to os.kill() then. Raises OSError if the process does not exist.
+  """
+  if not platform_util.is_running_on_linux():
+    return None
+  libc = ctypes.CDLL(None, use_errno=True)
+  pidfd = libc.syscall(_SYS_PIDFD_OPEN, pid, 0)
+  if pidfd < 0:
+    err = ctypes.get_errno()
+    if err == errno.ESRCH:
+      raise OSError(err, os.strerror(err))
+    return None
+  return pidfd
+
+
+def _kill_and_wait_by_pidfd(pidfd):
+  """Sends SIGKILL to the process referred by |pidfd| and waits its exit.
+
+  Unlike os.kill(), a signal sent via the pidfd never reaches another process
+  which happens to reuse the pid. Also, the pidfd becomes readable when the
+  process exits even if it is not our child, so no polling is needed.
+  Returns whether the process exited in time, or None if the signal cannot be
+  sent via the pidfd. Raises OSError if the process does not exist.
+  """
+  libc = ctypes.CDLL(None, use_errno=True)
+  if libc.syscall(_SYS_PIDFD_SEND_SIGNAL, pidfd, signal.SIGKILL, None, 0) < 0:
+    err = ctypes.get_errno()
+    if err == errno.ESRCH:
+      raise OSError(err, os.strerror(err))
+    return None
+  poller = select.poll()
+  poller.register(pidfd, select.POLLIN)
+  return bool(poller.poll(_CHROME_KILL_TIMEOUT * 1000))
+
+
+def _kill_and_wait_by_pid(pid):
+  """Sends SIGKILL to the process |pid| and waits its exit.
+
+  Returns whether the process exited in time.
+  """
+  os.kill(pid, signal.SIGKILL)
+
+  # Unfortunately, there is no convenient API to wait subprocess's
+  # termination with timeout. So, here we just poll it.
+  wait_time_limit = time.time() + _CHROME_KILL_TIMEOUT
+  while True:
+    retpid, status = os.waitpid(pid, os.WNOHANG)
+    if retpid:
+      return True
+    now = time.time()
+    if now > wait_time_limit:
+      return False
+    time.sleep(min(_CHROME_KILL_DELAY, wait_time_limit - now))
+
+
 def _kill_running_chrome():
-  pid = _read_chrome_pid_file()
-  if pid is None:
+  if not os.path.exists(_CHROME_PID_PATH):
     return
+  with _chrome_pid_file_lock():
+    pid = _read_chrome_pid_file()
+    if pid is None:
+      return
+    _kill_chrome_locked(pid)
+    _remove_chrome_pid_file_locked(pid)
+
 
+def _kill_chrome_locked(pid):
   try:
     # Use SIGKILL instead of more graceful signals, as Chrome's
     # behavior for other signals are not well defined nor
     # tested. Actually, we cannot kill Chrome with NaCl's debug stub
     # enabled by SIGTERM. Also, there was a similar issue in Bare
     # Metal mode with M39 Chrome. See crbug.com/433967.
-    os.kill(pid, signal.SIGKILL)
-
-    # Unfortunately, there is no convenient API to wait subprocess's
-    # termination with timeout. So, here we just poll it.
-    wait_time_limit = time.time() + _CHROME_KILL_TIMEOUT
-    while True:
-      retpid, status = os.waitpid(pid, os.WNOHANG)
-      if retpid:
-        break
-      now = time.time()
-      if now > wait_time_limit:
-        logging.error('Terminating Chrome is timed out: %d', pid)
-        break
-      time.sleep(min(_CHROME_KILL_DELAY, wait_time_limit - now))
+    exited = None
+    pidfd = _open_pidfd(pid)
+    if pidfd is not None:
+      try:
+        exited = _kill_and_wait_by_pidfd(pidfd)
+      finally:
+        os.close(pidfd)
+    if exited is None:
+      exited = _kill_and_wait_by_pid(pid)
+    if not exited:
+      logging.error('Terminating Chrome is timed out: %d', pid)
   except OSError:
     # Here we ignore the OS error. The process may have been terminated somehow
     # by external reason, while the file still exists on the file system.
     pass
 
-  _remove_chrome_pid_file(pid)
-
 
 def _remove_chrome_pid_file(pid):
+  if not os.path.exists(_CHROME_PID_PATH):
+    return
+  with _chrome_pid_file_lock():
+    _remove_chrome_pid_file_locked(pid)
+
+
+def _remove_chrome_pid_file_locked(pid):
   read_pid = _read_chrome_pid_file()
   if read_pid == pid:
     try:
@@ -129,15 +274,102 @@ def _prepare_chrome_user_data_dir(parsed_args):
     _USER_DATA_DIR = build_common.get_chrome_default_user_data_dir()
 
 
+class _InotifyRemovalWatch(object):
+  """Wakes up on removals of files next to |path|, using inotify (Linux).
+
+  The parent directory is watched rather than |path| itself so that the watch
+  does not depend on the file's inode.
+  """
+
+  def __init__(self, path):
+    libc = ctypes.CDLL(None, use_errno=True)
+    self._fd = libc.inotify_init1(_IN_CLOEXEC)
+    if self._fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    dirname = os.path.dirname(os.path.abspath(path))
+    if libc.inotify_add_watch(self._fd, dirname,
+                              _IN_DELETE | _IN_MOVED_FROM) < 0:
+      err = ctypes.get_errno()
+      os.close(self._fd)
+      raise OSError(err, os.strerror(err))
+
+  def wait(self, timeout):
+    """Waits for a removal for at most |timeout| seconds."""
+    if select.select([self._fd], [], [], timeout)[0]:
+      # Events are used only to wake up, so drain them without parsing.
+      os.read(self._fd, 4096)
+
+  def close(self):
+    os.close(self._fd)
+
+
+class _KqueueRemovalWatch(object):
+  """Wakes up on removal of |path|, using kqueue (Mac)."""
+
+  def __init__(self, path):
+    self._fd = os.open(path, os.O_RDONLY)
+    try:
+      self._kqueue = select.kqueue()
+    except Exception:
+      os.close(self._fd)
+      raise
+    try:
+      self._kqueue.control([select.kevent(
+          self._fd, filter=select.KQ_FILTER_VNODE,
+          flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+          fflags=select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME)], 0, 0)
+    except Exception:
+      self.close()
+      raise
+
+  def wait(self, timeout):
+    """Waits for a removal for at most |timeout| seconds."""
+    self._kqueue.control(None, 1, timeout)
+
+  def close(self):
+    self._kqueue.close()
+    os.close(self._fd)
+
+
+def _open_removal_watch(path):
+  """Returns a watch to wait for the removal of |path|.
+
+  Returns None if neither inotify nor kqueue is available.
+  """
+  try:
+    if platform_util.is_running_on_linux():
+      return _InotifyRemovalWatch(path)
+    if platform_util.is_running_on_mac():
+      return _KqueueRemovalWatch(path)
+  except (IOError, OSError):
+    # E.g. |path| is already removed, or the watch limit is reached. The
+    # caller falls back to polling.
+    logging.exception('Failed to watch %s', path)
+  return None
+
+
 def _maybe_wait_iteration_lock(parsed_args):
   if not parsed_args.iteration_lock_file:
     return
-  with open(parsed_args.iteration_lock_file, 'w'):
-    pass
+  os.close(os.open(parsed_args.iteration_lock_file,
+                   os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666))
+  # Start watching before announcing the lock so that its removal is not
+  # missed.
+  watch = _open_removal_watch(parsed_args.iteration_lock_file)
   # This message is hard-coded in interleaved_perftest.py. Don't change it.
   sys.stderr.write('waiting for next iteration\n')
-  while os.path.exists(parsed_args.iteration_lock_file):
-    time.sleep(0.1)
+  if watch is None:
+    while os.path.exists(parsed_args.iteration_lock_file):
+      time.sleep(0.1)
+    return
+
+  try:
+    while os.path.exists(parsed_args.iteration_lock_file):
+      # The timeout is just a safety net.
+      watch.wait(1)
+  finally:
+    watch.close()
 
 
 def _run_chrome_iterations(parsed_args):
@@ -183,10 +415,13 @@ def _check_crx_existence(parsed_args):
 
 
 def _get_chrome_path(parsed_args):
-  if parsed_args.chrome_binary:
-    return parsed_args.chrome_binary
-  else:
-    return remote_executor.get_chrome_exe_path()
+  global _CHROME_PATH
+  if _CHROME_PATH is None:
+    if parsed_args.chrome_binary:
+      _CHROME_PATH = parsed_args.chrome_binary
+    else:
+      _CHROME_PATH = remote_executor.get_chrome_exe_path()
+  return _CHROME_PATH
 
 
 def _get_nacl_helper_nonsfi_path(parsed_args):
@@ -197,17 +432,20 @@ def _get_nacl_helper_nonsfi_path(parsed_args):
 
 
 def _get_nacl_irt_path(parsed_args):
+  global _NACL_IRT_PATH
   if not OPTIONS.is_nacl_build():
     return None
-  chrome_path = _get_chrome_path(parsed_args)
-  irt = toolchain.get_tool(OPTIONS.target(), 'irt')
-  nacl_irt_path = os.path.join(os.path.dirname(chrome_path), irt)
-  nacl_irt_debug_path = nacl_irt_path + '.debug'
-  # Use debug version nacl_irt if it exists.
-  if os.path.exists(nacl_irt_debug_path):
-    return nacl_irt_debug_path
-  else:
-    return nacl_irt_path
+  if _NACL_IRT_PATH is None:
+    chrome_path = _get_chrome_path(parsed_args)
+    irt = toolchain.get_tool(OPTIONS.target(), 'irt')
+    nacl_irt_path = os.path.join(os.path.dirname(chrome_path), irt)
+    nacl_irt_debug_path = nacl_irt_path + '.debug'
+    # Use debug version nacl_irt if it exists.
+    if os.path.exists(nacl_irt_debug_path):
+      _NACL_IRT_PATH = nacl_irt_debug_path
+    else:
+      _NACL_IRT_PATH = nacl_irt_path
+  return _NACL_IRT_PATH
 
 
 def main():
@@ -394,43 +632,6 @@ def _compute_chrome_diagnostic_params(parsed_args):
   return (params, params_startwith)
 
 
-def _compute_chrome_performance_test_params(unused_parsed_args):
-  """Add params that are necessary for stable perftest result."""
-  params = []
-
-  # Skip First Run tasks, whether or not it's actually the First Run.
-  params.append('--no-first-run')
-
-  # Disable default component extensions with background pages - useful for
-  # performance tests where these pages may interfere with perf results.
-  params.append('--disable-component-extensions-with-background-pages')
-
-  # Enable the recording of metrics reports but disable reporting. In contrast
-  # to kDisableMetrics, this executes all the code that a normal client would
-  # use for reporting, except the report is dropped rather than sent to the
-  # server. This is useful for finding issues in the metrics code during UI and
-  # performance tests.
-  params.append('--metrics-recording-only')
-
-  # Disable several subsystems which run network requests in the background.
-  # This is for use when doing network performance testing to avoid noise in the
-  # measurements.
-  params.append('--disable-background-networking')
-
-  # They are copied from
-  #  ppapi/native_client/tools/browser_tester/browsertester/browserlauncher.py
-  # These features could be a source of non-determinism too.
-  params.append('--disable-default-apps')
-  params.append('--disable-preconnect')
-  params.append('--disable-sync')
-  params.append('--disable-web-resources')
-  params.append('--dns-prefetch-disable')
-  params.append('--no-default-browser-check')
-  params.append('--safebrowsing-disable-auto-update')
-
-  return params
-
-
 def _compute_chrome_params(parsed_args):
   chrome_path = _get_chrome_path(parsed_args)
   params = [chrome_path]
@@ -444,7 +645,7 @@ def _compute_chrome_params(parsed_args):
     # integration tests and perf score. Do not append these flags in run mode
     # because apps that depend on component extensions (e.g. Files.app) will not
     # work with these flags.
-    params.extend(_compute_chrome_performance_test_params(parsed_args))
+    params.extend(_CHROME_PERFORMANCE_TEST_PARAMS)
     # Make the window size small on Goobuntu so that it does not cover the whole
     # desktop during perftest/integration_test.
     params.append('--window-size=500,500')
@@ -491,6 +692,18 @@ def _compute_chrome_params(parsed_args):
   return params
 
 
+def _get_chrome_params(parsed_args):
+  """Returns the Chrome command line, computing it on the first call only.
+
+  Computing it may run subprocesses on remote hosts (e.g. xdpyinfo on Chrome
+  OS and cygpath on Windows), so it is not repeated for each iteration.
+  """
+  global _CHROME_PARAMS
+  if _CHROME_PARAMS is None:
+    _CHROME_PARAMS = _compute_chrome_params(parsed_args)
+  return _CHROME_PARAMS
+
+
 def _should_timeouts_be_used(parsed_args):
   if parsed_args.jdb_port or parsed_args.gdb:
     # Do not apply a timeout if debugging
@@ -515,8 +728,7 @@ def _select_output_handler(parsed_args, stats, chrome_process, **kwargs):
     handler = output_handler.PerfTestHandler(
         parsed_args, stats, chrome_process, **kwargs)
   else:
-    handler = concurrent_subprocess.RedirectOutputHandler(
-        *['.*' + re.escape(suppress) for suppress in _SUPPRESS_LIST])
+    handler = concurrent_subprocess.RedirectOutputHandler(_SUPPRESS_PATTERN)
 
   if 'gpu' in parsed_args.gdb or 'renderer' in parsed_args.gdb:
     handler = gdb_util.GdbHandlerAdapter(
@@ -573,7 +785,7 @@ def _run_chrome(parsed_args, **kwargs):
     subprocess.Popen(
         [toolchain.get_tool('host', 'adb'), 'logcat'] + parsed_args.logcat)
 
-  params = _compute_chrome_params(parsed_args)
+  params = _get_chrome_params(parsed_args)
   gdb_util.create_or_remove_bare_metal_gdb_lock_dir(parsed_args.gdb)
 
   # Similar to adb subprocess, using atexit has timing issue. See above comment
@@ -593,8 +805,13 @@ def _run_chrome(parsed_args, **kwargs):
     # same user data can find the process. In common case, the file will be
     # removed by _terminate_chrome() defined above.
     file_util.makedirs_safely(_USER_DATA_DIR)
-    with open(_CHROME_PID_PATH, 'w') as pid_file:
-      pid_file.write('%d\n' % p.pid)
+    with _chrome_pid_file_lock():
+      pid_fd = os.open(_CHROME_PID_PATH,
+                       os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+      try:
+        os.write(pid_fd, '%d\n' % p.pid)
+      finally:
+        os.close(pid_fd)
 
     stats = startup_stats.StartupStats()
     handler = _select_output_handler(parsed_args, stats, p, **kwargs)
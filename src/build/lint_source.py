@@ -11,9 +11,11 @@ import glob
 import itertools
 import json
 import logging
+import multiprocessing
 import os
 import re
 import shlex
+import stat
 import subprocess
 import sys
 import tempfile
@@ -21,6 +23,7 @@ import tempfile
 from src.build import analyze_diffs
 from src.build import build_common
 from src.build import open_source
+from src.build.util import concurrent
 from src.build.util import file_util
 from src.build.util import logging_util
 
@@ -477,9 +480,10 @@ class LinterRunner(object):
 
   def run(self, path):
     # In is_tracking_an_upstream_file, the path is opened.
-    # To avoid invoking it many times for a file, we cache the result, and
-    # pass it to Linter.should_run() method via an argument.
-    is_tracking_upstream = analyze_diffs.is_tracking_an_upstream_file(path)
+    # To avoid invoking it many times for a file, we cache the result. It is
+    # computed lazily, because for many files (e.g. OWNERS) no linter which
+    # cares about it passes the other rules.
+    is_tracking_upstream = None
     group = LinterRunner._EXTENSION_GROUP_MAP.get(
         os.path.splitext(path)[1].lower())
     result = True
@@ -487,12 +491,17 @@ class LinterRunner(object):
       # Common rule to check if linter should be applied to the file.
       if (linter.name in self._ignore_rule.get(path, []) or
           (linter.target_groups and group not in linter.target_groups) or
-          (linter.ignore_upstream_tracking_file and is_tracking_upstream) or
           (linter.ignore_mods and path.startswith('mods/'))):
         continue
       # Also, check each linter specific rule.
       if not linter.should_run(path):
         continue
+      if linter.ignore_upstream_tracking_file:
+        if is_tracking_upstream is None:
+          is_tracking_upstream = (
+              analyze_diffs.is_tracking_an_upstream_file(path))
+        if is_tracking_upstream:
+          continue
 
       logging.info('%- 10s: %s', linter.name, path)
       result &= linter.run(path)
@@ -516,10 +525,15 @@ def _run_lint(target_file_list, ignore_rule, output_dir):
        CopyrightLinter(), UpstreamLinter(), LicenseLinter(),
        OpenSourceLinter(), DiffLinter(output_dir)],
       ignore_rule)
-  result = True
-  for path in target_file_list:
-    result &= runner.run(path)
-  return result
+  # Most linters run as a child process, so threads are enough to lint files
+  # in parallel. Note that each ninja lint step passes only one file, but
+  # git_pre_push.py and manual invocations may pass many.
+  with concurrent.ThreadPoolExecutor(
+      max_workers=max(1, min(len(target_file_list),
+                             multiprocessing.cpu_count())),
+      daemon=True) as executor:
+    futures = [executor.submit(runner.run, path) for path in target_file_list]
+  return all([future.result() for future in futures])
 
 
 def _process_analyze_diffs_output(output_dir):
@@ -560,10 +574,6 @@ def _should_ignore(filename):
   """Returns True if any linter should not apply to the file."""
   extension = os.path.splitext(filename)[1]
   basename = os.path.basename(filename)
-  if os.path.isdir(filename):
-    return True
-  if os.path.islink(filename):
-    return True
   if build_common.is_common_editor_tmp_file(basename):
     return True
   if extension == '.pyc':
@@ -572,6 +582,15 @@ def _should_ignore(filename):
     return True
   if filename.startswith('docs/'):
     return True
+  # Check directories and symlinks last, with a single lstat() call, as they
+  # need a syscall unlike the checks above.
+  try:
+    mode = os.lstat(filename).st_mode
+  except OSError:
+    # Keep non-existent files, as os.path.isdir() and islink() would do.
+    return False
+  if stat.S_ISDIR(mode) or stat.S_ISLNK(mode):
+    return True
   return False
 
 
@@ -639,7 +658,7 @@ def process(target_path_list, ignore_file=None, output_file=None):
     if output_file:
       statistic_list = _process_analyze_diffs_output(output_dir)
       with open(output_file, 'wb') as stream:
-        cPickle.dump(statistic_list, stream)
+        cPickle.dump(statistic_list, stream, cPickle.HIGHEST_PROTOCOL)
   finally:
     if output_dir:
       file_util.rmtree(output_dir)
@@ -648,7 +667,7 @@ def process(target_path_list, ignore_file=None, output_file=None):
 
 def _all_file_statistics(files):
   for filename in files:
-    with open(filename) as f:
+    with open(filename, 'rb') as f:
       for file_statistics in cPickle.load(f):
         yield file_statistics
 
@@ -90,6 +90,11 @@ class Popen(object):
   # this class tries to kill().
   _SHUTDOWN_WAIT_SECONDS = 5
 
+  # Interval range to poll the subprocess in wait(), in seconds. The upper
+  # bound was chosen heuristically.
+  _MIN_WAIT_POLL_INTERVAL = 0.001
+  _MAX_WAIT_POLL_INTERVAL = 0.1
+
   def __init__(self, args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                cwd=None, env=None, timeout=None, subprocess_factory=None):
     """Constructs the Popen instance.
@@ -231,15 +236,19 @@ class Popen(object):
     Returns status code, or None if timed out.
     """
     deadline = None if timeout is None else time.time() + timeout
+    interval = Popen._MIN_WAIT_POLL_INTERVAL
     while True:
-      # Because poll is guarded by the lock, we can just use busy-loop with
-      # 0.1 secs interval (chosen heuristically).
+      # Because poll is guarded by the lock, we can just use busy-loop.
+      # The interval starts short and grows, because the subprocess usually
+      # exits soon after its stdout and stderr are closed, e.g. right after
+      # handle_output() finishes reading them.
       result = self.poll()
       if (result is not None or
           (deadline is not None and time.time() >= deadline)):
         # If subprocess is terminated or timed out, return the result.
         return result
-      time.sleep(0.1)
+      time.sleep(interval)
+      interval = min(interval * 2, Popen._MAX_WAIT_POLL_INTERVAL)
 
   def handle_output(self, output_handler):
     """Reads output from the subprocess, wait()s until the termination.
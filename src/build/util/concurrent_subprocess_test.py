@@ -19,19 +19,29 @@ class SimpleOutputHandler(concurrent_subprocess.OutputHandler):
   def __init__(self):
     super(SimpleOutputHandler, self).__init__()
     self.done = False
-    self.stdout = ''
-    self.stderr = ''
+    # Output is accumulated as a list of chunks and joined on access, so
+    # that large outputs do not cause quadratic string concatenation.
+    self._stdout_parts = []
+    self._stderr_parts = []
     self.timeout = False
     self.returncode = None
 
+  @property
+  def stdout(self):
+    return ''.join(self._stdout_parts)
+
+  @property
+  def stderr(self):
+    return ''.join(self._stderr_parts)
+
   def is_done(self):
     return self.done
 
   def handle_stdout(self, line):
-    self.stdout += line
+    self._stdout_parts.append(line)
 
   def handle_stderr(self, line):
-    self.stderr += line
+    self._stderr_parts.append(line)
 
   def handle_timeout(self):
     self.timeout = True
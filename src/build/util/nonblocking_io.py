@@ -10,12 +10,15 @@ read on Windows is more complicated, so we rely on fcntl for now to keep the
 implementation simpler.
 """
 
+import collections
 import errno
 import fcntl
 import io
 import os
 
-_READ_DATA_SIZE = 4096
+# Read up to the default pipe capacity on Linux at once, so that a burst of
+# output is drained with a few read() calls.
+_READ_DATA_SIZE = 64 * 1024
 
 
 def _set_nonblocking(fd):
@@ -85,7 +88,7 @@ class LineReader(object):
     self._stream = stream
     _set_nonblocking(stream.fileno())
     self._pending = ''
-    self._lines = []
+    self._lines = collections.deque()
 
   def close(self):
     # Clear pending data.
@@ -136,7 +139,7 @@ class LineReader(object):
       raise ValueError('I/O operation on closed file')
 
     if self._lines:
-      return self._lines.pop(0)
+      return self._lines.popleft()
 
     # Read available data from the file descriptor as much as possible.
     read_data, eof = _read_available_data(self._stream.fileno())
@@ -155,5 +158,5 @@ class LineReader(object):
         raise io.BlockingIOError(errno.EAGAIN, LineReader._EAGAIN_MESSAGE)
       return ''
 
-    self._lines = split_lines[1:]
+    self._lines.extend(split_lines[1:])
     return split_lines[0]
@@ -372,14 +372,15 @@ class PerfTestHandler(concurrent_subprocess.OutputHandler):
 
 
 class ArcStraceFilter(concurrent_subprocess.DelegateOutputHandlerBase):
+  _ARC_STRACE_PATTERN = re.compile(r'\[\[arc_strace\]\]: ')
+
   def __init__(self, base_handler, output_filename):
     super(ArcStraceFilter, self).__init__(base_handler)
     self._strace_output = open(output_filename, 'w', buffering=0)
-    self._arc_strace_pattern = re.compile(r'\[\[arc_strace\]\]: ')
     self._line_buffer = []
 
   def handle_stderr(self, line):
-    matched = self._arc_strace_pattern.search(line)
+    matched = self._ARC_STRACE_PATTERN.search(line)
     if matched:
       # Found [[arc_strace]]: marker. Output to the file.
       self._strace_output.write(line[matched.end():])
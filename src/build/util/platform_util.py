@@ -9,6 +9,9 @@ import sys
 
 _LSB_RELEASE_PATH = '/etc/lsb-release'
 
+# Cached result of is_running_on_chromeos().
+_cached_is_running_on_chromeos = None
+
 
 def is_running_on_linux():
   return sys.platform.startswith('linux')
@@ -22,7 +25,7 @@ def is_running_on_mac():
   return sys.platform == 'darwin'
 
 
-def is_running_on_chromeos():
+def _check_running_on_chromeos():
   # Check if Chrome OS specific entry exists in lsb-release file, which contains
   # Linux distribution information.
   if not os.path.exists(_LSB_RELEASE_PATH):
@@ -34,6 +37,15 @@ def is_running_on_chromeos():
   return False
 
 
+def is_running_on_chromeos():
+  # The result never changes while running, but this is called many times,
+  # e.g. via is_running_on_remote_host(), so the file is read only once.
+  global _cached_is_running_on_chromeos
+  if _cached_is_running_on_chromeos is None:
+    _cached_is_running_on_chromeos = _check_running_on_chromeos()
+  return _cached_is_running_on_chromeos
+
+
 def get_lsb_distrib_codename():
   if not os.path.exists(_LSB_RELEASE_PATH):
     return None
@@ -3,6 +3,7 @@
 # found in the LICENSE file.
 
 import collections
+import json
 
 from src.build.util import statistics
 
@@ -44,7 +45,7 @@ def _build_raw_stats(stats_list):
 
 def print_raw_stats(stats):
   """Prints the VRAWPERF= line of the given |stats|."""
-  print 'VRAWPERF=%s' % dict(_build_raw_stats([stats]))
+  print 'VRAWPERF=%s' % json.dumps(_build_raw_stats([stats]))
 
 
 def print_aggregated_stats(stats_list):
@@ -75,7 +76,7 @@ def print_aggregated_stats(stats_list):
       }
 
     # Print VRAWPERF= line.
-    print 'VRAWPERF=%s' % dict(raw_stats)
+    print 'VRAWPERF=%s' % json.dumps(raw_stats)
 
   # Note: since each value is the median for each data set, they are not
   # guaranteed to add up.